@@ -19,19 +19,25 @@ from builtins import object
 
 from cgi import escape
 from io import BytesIO as IO
+import calendar
 import functools
 import gzip
 import dateutil.parser as dateparser
 import json
-import time
 
 from flask import after_this_request, request, Response, g
 from flask_login import current_user
+from jinja2.utils import LRUCache
 import wtforms
 from wtforms.compat import text_type
 
 from airflow import configuration, models, settings
-from airflow.utils.json import AirflowJsonEncoder
+from airflow.utils.json import AirflowJsonEncoder, json_ser
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 AUTHENTICATE = configuration.getboolean('webserver', 'AUTHENTICATE')
 
@@ -45,9 +51,17 @@ DEFAULT_SENSITIVE_VARIABLE_FIELDS = (
     'access_token',
 )
 
+# The variable list asks once per row, and again on every page load
+_hidden_keys = LRUCache(1024)
+
+
 def should_hide_value_for_key(key_name):
-    return any(s in key_name.lower() for s in DEFAULT_SENSITIVE_VARIABLE_FIELDS) \
-           and configuration.getboolean('admin', 'hide_sensitive_variable_fields')
+    hide = _hidden_keys.get(key_name)
+    if hide is None:
+        hide = any(s in key_name.lower() for s in DEFAULT_SENSITIVE_VARIABLE_FIELDS) \
+               and configuration.getboolean('admin', 'hide_sensitive_variable_fields')
+        _hidden_keys[key_name] = hide
+    return hide
 
 
 def get_params(**kwargs):
@@ -200,9 +214,38 @@ def limit_sql(sql, limit, conn_type):
     return sql
 
 
+def iter_csv(df, chunksize=10000):
+    """
+    Yields a dataframe as CSV, ``chunksize`` rows at a time, so large
+    results can be streamed without holding the whole document in memory
+    """
+    for start in range(0, max(len(df), 1), chunksize):
+        yield df.iloc[start:start + chunksize].to_csv(
+            index=False, header=(start == 0))
+
+
+def iter_json_object(obj, indent=4):
+    """
+    Yields a dict as the document json.dumps(obj, sort_keys=True,
+    indent=indent) would return, one top-level entry at a time
+    """
+    if not obj:
+        yield '{}'
+        return
+    pad = ' ' * indent
+    prefix = '{\n'
+    for key in sorted(obj):
+        value = json.dumps(obj[key], sort_keys=True, indent=indent,
+                           separators=(',', ': '))
+        yield '{}{}{}: {}'.format(
+            prefix, pad, json.dumps(key), value.replace('\n', '\n' + pad))
+        prefix = ',\n'
+    yield '\n}'
+
+
 def epoch(dttm):
-    """Returns an epoch-type date"""
-    return int(time.mktime(dttm.timetuple())) * 1000,
+    """Returns an epoch-type date, reading naive datetimes as UTC"""
+    return int(calendar.timegm(dttm.timetuple())) * 1000,
 
 
 def action_logging(f):
@@ -284,17 +327,55 @@ def notify_owner(f):
     return wrapper
 
 
+def dumps(obj):
+    """
+    Serializes obj to json, using orjson when it is installed. Dates and
+    other non-native types are always handed to AirflowJsonEncoder so the
+    output format does not depend on the backend.
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            obj,
+            default=AirflowJsonEncoder().default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, indent=4, cls=AirflowJsonEncoder)
+
+
+def compact_dumps(obj, default=json_ser):
+    """
+    Serializes obj to compact json text, as embedded in pages for their
+    javascript, using orjson when it is installed
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            obj,
+            default=default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        ).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), default=default)
+
+
 def json_response(obj):
     """
     returns a json response from a json serializable python object
     """
     return Response(
-        response=json.dumps(
-            obj, indent=4, cls=AirflowJsonEncoder),
+        response=dumps(obj),
         status=200,
         mimetype="application/json")
 
 
+def conditional_json_response(obj):
+    """
+    returns a json response tagged with an ETag of its content, or an empty
+    304 response if the client already holds that version. The ETag is weak
+    since gzipped may send the same content compressed.
+    """
+    response = json_response(obj)
+    response.add_etag(weak=True)
+    return response.make_conditional(request)
+
+
 def gzipped(f):
     '''
     Decorator to make a view compressed
@@ -304,10 +385,16 @@ def gzipped(f):
         @after_this_request
         def zipper(response):
             accept_encoding = request.headers.get('Accept-Encoding', '')
+            # the body depends on Accept-Encoding whether or not it ends up
+            # compressed, so caches must keep the variants apart
+            response.vary.add('Accept-Encoding')
 
             if 'gzip' not in accept_encoding.lower():
                 return response
 
+            if response.is_streamed:
+                return response
+
             response.direct_passthrough = False
 
             if (response.status_code < 200 or
@@ -322,7 +409,6 @@ def gzipped(f):
 
             response.data = gzip_buffer.getvalue()
             response.headers['Content-Encoding'] = 'gzip'
-            response.headers['Vary'] = 'Accept-Encoding'
             response.headers['Content-Length'] = len(response.data)
 
             return response
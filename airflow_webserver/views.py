@@ -19,15 +19,18 @@ import ast
 import logging
 import os
 import pkg_resources
+import re
 import socket
+import threading
+import time
 from functools import wraps
 from datetime import datetime, timedelta
 import dateutil.parser
 import copy
+import itertools
 import math
 import json
-import bleach
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 import inspect
 from textwrap import dedent
@@ -38,7 +41,7 @@ from sqlalchemy import or_, desc, and_, union_all
 
 from flask import (
     g, redirect, url_for, request, Markup, Response, render_template,
-    make_response, abort, flash)
+    abort, flash)
 from flask._compat import PY2
 
 from flask_appbuilder import BaseView, ModelView, IndexView, expose, has_access, AppBuilder
@@ -50,6 +53,7 @@ from flask_babel import lazy_gettext
 
 from jinja2.sandbox import ImmutableSandboxedEnvironment
 from jinja2 import escape
+from jinja2.utils import LRUCache
 
 import markdown
 import nvd3
@@ -65,14 +69,12 @@ from airflow import models, jobs
 from airflow import settings
 from airflow.api.common.experimental.mark_tasks import set_dag_run_state
 from airflow.exceptions import AirflowException
-from airflow.settings import Session
 from airflow.models import XCom, DagRun
 from airflow.ti_deps.dep_context import DepContext, QUEUE_DEPS, SCHEDULER_DEPS
 
 from airflow.models import BaseOperator
 from airflow.operators.subdag_operator import SubDagOperator
 
-from airflow.utils.json import json_ser
 from airflow.utils.state import State
 from airflow.utils.db import provide_session
 from airflow.utils.helpers import alchemy_to_dict
@@ -88,8 +90,90 @@ QUERY_LIMIT = 100000
 CHART_LIMIT = 200000
 
 PAGE_SIZE = conf.getint('webserver', 'page_size')
+DEMO_MODE = conf.getboolean('webserver', 'demo_mode')
 
-dagbag = models.DagBag(settings.DAGS_FOLDER)
+# Seconds between background passes picking up changed DAG files
+DAGBAG_REFRESH_INTERVAL = 30
+
+_dagbag = None
+# Held for every call that may parse files into the dagbag or drop DAGs
+# from it: its creation, get_dag (which reloads stale DAGs) and the rescans
+# of the DAGs folder. Request handlers iterate over copies of dagbag.dags.
+# Reentrant, as get_dag creates the dagbag on first use.
+_dagbag_lock = threading.RLock()
+
+
+def get_dagbag():
+    """
+    Returns the webserver's DagBag, parsing the DAGs folder on first use
+    rather than at import time
+    """
+    global _dagbag
+    if _dagbag is None:
+        with _dagbag_lock:
+            if _dagbag is None:
+                _dagbag = models.DagBag(settings.DAGS_FOLDER)
+    return _dagbag
+
+
+def get_dag(dag_id):
+    """
+    Returns a DAG from the webserver's DagBag, through DagBag.get_dag which
+    reparses its file if the DAG was expired since it was loaded
+    """
+    with _dagbag_lock:
+        return get_dagbag().get_dag(dag_id)
+
+
+def collect_dags(only_if_updated=True):
+    """
+    Rescans the DAGs folder into the webserver's DagBag
+    """
+    with _dagbag_lock:
+        get_dagbag().collect_dags(only_if_updated=only_if_updated)
+
+
+def refresh_dagbag(interval=DAGBAG_REFRESH_INTERVAL):
+    """
+    Loads the dagbag, then reparses changed DAG files every ``interval``
+    seconds, so that request handlers find their DAGs already parsed
+    """
+    while True:
+        try:
+            collect_dags(only_if_updated=True)
+        except Exception:
+            logging.exception("Failed to refresh the dagbag")
+        time.sleep(interval)
+
+
+@appbuilder.app.before_first_request
+def start_dagbag_refresh():
+    thread = threading.Thread(target=refresh_dagbag, name='dagbag-refresh')
+    thread.daemon = True
+    thread.start()
+
+
+# Attributes listed on the task instance details page
+TI_ATTRS = (
+    'dag_id', 'duration', 'end_date', 'execution_date', 'hostname', 'job_id',
+    'max_tries', 'operator', 'pid', 'pool', 'priority_weight', 'queue',
+    'queued_dttm', 'start_date', 'state', 'task_id', 'try_number', 'unixname',
+)
+TASK_ATTRS = (
+    'adhoc', 'depends_on_past', 'downstream_task_ids', 'email',
+    'email_on_failure', 'email_on_retry', 'end_date', 'execution_timeout',
+    'max_retry_delay', 'owner', 'params', 'pool', 'priority_weight', 'queue',
+    'resources', 'retries', 'retry_delay', 'retry_exponential_backoff',
+    'run_as_user', 'schedule_interval', 'sla', 'start_date', 'task_id',
+    'task_type', 'template_ext', 'template_fields', 'trigger_rule',
+    'ui_color', 'ui_fgcolor', 'upstream_task_ids', 'wait_for_downstream',
+)
+
+DAG_STATES = tuple(State.dag_states)
+TASK_STATES = tuple(State.task_states)
+STATE_COLORS = {
+    state: State.color(state)
+    for state in set(DAG_STATES + TASK_STATES) | set(State.state_color)}
 
 FILTER_BY_OWNER = False
 
@@ -97,9 +181,11 @@ if conf.getboolean('webserver', 'FILTER_BY_OWNER'):
     # filter_by_owner if authentication is enabled and filter_by_owner is true
     FILTER_BY_OWNER = not appbuilder.app.config['LOGIN_DISABLED']
 
+# Link formatters build their HTML with Markup.format, which escapes the
+# interpolated ids and urls; url_for takes care of quoting query arguments.
 def task_instance_link(attr):
-    dag_id = bleach.clean(attr.get('dag_id'))
-    task_id = bleach.clean(attr.get('task_id'))
+    dag_id = attr.get('dag_id')
+    task_id = attr.get('task_id')
     execution_date = attr.get('execution_date')
     url = url_for(
         'Airflow.task',
@@ -120,13 +206,13 @@ def task_instance_link(attr):
             aria-hidden="true"></span>
         </a>
         </span>
-        """.format(**locals()))
+        """).format(url=url, task_id=task_id, url_root=url_root)
 
 def state_token(state):
-    color = State.color(state)
+    color = STATE_COLORS.get(state) or State.color(state)
     return Markup(
         '<span class="label" style="background-color:{color};">'
-        '{state}</span>'.format(**locals()))
+        '{state}</span>').format(color=color, state=state)
 
 def state_f(attr):
     state = attr.get('state')
@@ -138,28 +224,35 @@ def nobr_f(field):
         return Markup("<nobr>{}</nobr>".format(f))
     return nobr_f_helper
 
+@appbuilder.app.before_request
+def set_current_year_prefix():
+    # Read by datetime_f for every date cell of a list view
+    g.current_year_prefix = str(datetime.utcnow().year) + '-'
+
 def datetime_f(field):
     def datetime_f_helper(attr):
         f = attr.get(field)
-        f = f.isoformat() if f else ''
-        if datetime.now().isoformat()[:4] == f[:4]:
+        if not f:
+            return Markup("<nobr></nobr>")
+        f = f.isoformat()
+        if f.startswith(g.current_year_prefix):
             f = f[5:]
-        return Markup("<nobr>{}</nobr>".format(f))
+        return Markup("<nobr>" + f + "</nobr>")
     return datetime_f_helper
 
 def dag_link(attr):
-    dag_id = bleach.clean(attr.get('dag_id'))
+    dag_id = attr.get('dag_id')
     execution_date = attr.get('execution_date')
     url = url_for(
         'Airflow.graph',
         dag_id=dag_id,
         execution_date=execution_date)
     return Markup(
-        '<a href="{}">{}</a>'.format(url, dag_id))
+        '<a href="{}">{}</a>').format(url, dag_id)
 
 def dag_run_link(attr):
-    dag_id = bleach.clean(attr.get('dag_id'))
-    run_id = bleach.clean(attr.get('run_id'))
+    dag_id = attr.get('dag_id')
+    run_id = attr.get('run_id')
     execution_date = attr.get('execution_date')
     url = url_for(
         'Airflow.graph',
@@ -167,63 +260,244 @@ def dag_run_link(attr):
         run_id=run_id,
         execution_date=execution_date)
     return Markup(
-        '<a href="{url}">{run_id}</a>'.format(**locals()))
+        '<a href="{url}">{run_id}</a>').format(url=url, run_id=run_id)
+
+# Pygments lexers and formatters are stateless once built, but building them
+# compiles their regex tables, so share one instance per class across requests.
+_lexers = {}
+_linenos_formatter = HtmlFormatter(linenos=True)
+_noclasses_formatter = HtmlFormatter(noclasses=True)
+
+
+def get_lexer(lexer):
+    if lexer not in _lexers:
+        _lexers[lexer] = lexer()
+    return _lexers[lexer]
 
-def pygment_html_render(s, lexer=lexers.TextLexer):
-    return highlight(
-        s,
-        lexer(),
-        HtmlFormatter(linenos=True),
-    )
 
 def render(obj, lexer):
-    out = ""
+    """
+    Highlights a string, or each string of a list or dict, with an
+    already instantiated lexer
+    """
     if isinstance(obj, basestring):
-        out += pygment_html_render(obj, lexer)
-    elif isinstance(obj, (tuple, list)):
+        return highlight(obj, lexer, _linenos_formatter)
+    parts = []
+    if isinstance(obj, (tuple, list)):
         for i, s in enumerate(obj):
-            out += "<div>List item #{}</div>".format(i)
-            out += "<div>" + pygment_html_render(s, lexer) + "</div>"
+            parts.append("<div>List item #{}</div><div>".format(i))
+            parts.append(highlight(s, lexer, _linenos_formatter))
+            parts.append("</div>")
     elif isinstance(obj, dict):
         for k, v in obj.items():
-            out += '<div>Dict item "{}"</div>'.format(k)
-            out += "<div>" + pygment_html_render(v, lexer) + "</div>"
-    return out
+            parts.append('<div>Dict item "{}"</div><div>'.format(k))
+            parts.append(highlight(v, lexer, _linenos_formatter))
+            parts.append("</div>")
+    return "".join(parts)
+
+
+def lexer_renderer(lexer):
+    """
+    Returns a renderer bound to a shared instance of the ``lexer`` class
+    """
+    lexer = get_lexer(lexer)
+    return lambda x: render(x, lexer)
+
+# Highlighted DAG sources keyed on (fileloc, mtime, size, first, last line);
+# least recently viewed entries are evicted first.
+CODE_CACHE_SIZE = 256
+CODE_MAX_LINES = 2000
+_code_cache = OrderedDict()
+
+
+def render_dag_source(fileloc, start=1, end=CODE_MAX_LINES):
+    """
+    Highlights lines ``start`` to ``end`` (1-indexed, inclusive) of a DAG
+    file. Returns the HTML and whether the file continues past ``end``.
+    """
+    st = os.stat(fileloc)
+    key = (fileloc, st.st_mtime, st.st_size, start, end)
+    rendered = _code_cache.pop(key, None)
+    if rendered is None:
+        with open(fileloc, 'r') as f:
+            code = ''.join(itertools.islice(f, start - 1, end))
+            has_more = next(f, None) is not None
+        if start == 1:
+            formatter = _linenos_formatter
+        else:
+            formatter = HtmlFormatter(linenos=True, linenostart=start)
+        rendered = (
+            highlight(code, get_lexer(lexers.PythonLexer), formatter),
+            has_more)
+        while len(_code_cache) >= CODE_CACHE_SIZE:
+            _code_cache.popitem(last=False)
+    _code_cache[key] = rendered
+    return rendered
+
+
+# Chart SQL and labels are user-provided templates; compile each distinct
+# source once instead of on every dashboard refresh.
+_sandbox = ImmutableSandboxedEnvironment()
+_chart_templates = LRUCache(1024)
+
+
+def compile_chart_template(source):
+    template = _chart_templates.get(source)
+    if template is None:
+        template = _sandbox.from_string(source)
+        _chart_templates[source] = template
+    return template
+
+
+# Rendered DAG and task docs, keyed on their markdown source
+_markdown_cache = LRUCache(256)
+
+
+def render_markdown(s):
+    html = _markdown_cache.get(s)
+    if html is None:
+        html = markdown.markdown(s)
+        _markdown_cache[s] = html
+    return html
 
 
 def wrapped_markdown(s):
-    return '<div class="rich_doc">' + markdown.markdown(s) + "</div>"
+    return '<div class="rich_doc">' + render_markdown(s) + "</div>"
+
+
+# The configuration page, kept until the config file changes on disk
+_config_page = {}
+
+
+def get_config_page():
+    """
+    Returns the text of the Airflow config file, the table of its effective
+    settings and the file highlighted as HTML
+    """
+    st = os.stat(conf.AIRFLOW_CONFIG)
+    file_key = (conf.AIRFLOW_CONFIG, st.st_mtime, st.st_size)
+    page = _config_page.get(file_key)
+    if page is None:
+        with open(conf.AIRFLOW_CONFIG, 'r') as f:
+            config = f.read()
+        table = [(section, key, value, source)
+                 for section, parameters in conf.as_dict(True, True).items()
+                 for key, (value, source) in parameters.items()]
+        code_html = Markup(highlight(
+            config,
+            get_lexer(lexers.IniLexer),
+            _noclasses_formatter)
+        )
+        page = (config, table, code_html)
+        _config_page.clear()
+        _config_page[file_key] = page
+    return page
+
+_python_renderer = lexer_renderer(lexers.PythonLexer)
 
 attr_renderer = {
-    'bash_command': lambda x: render(x, lexers.BashLexer),
-    'hql': lambda x: render(x, lexers.SqlLexer),
-    'sql': lambda x: render(x, lexers.SqlLexer),
-    'doc': lambda x: render(x, lexers.TextLexer),
-    'doc_json': lambda x: render(x, lexers.JsonLexer),
-    'doc_rst': lambda x: render(x, lexers.RstLexer),
-    'doc_yaml': lambda x: render(x, lexers.YamlLexer),
+    'bash_command': lexer_renderer(lexers.BashLexer),
+    'hql': lexer_renderer(lexers.SqlLexer),
+    'sql': lexer_renderer(lexers.SqlLexer),
+    'doc': lexer_renderer(lexers.TextLexer),
+    'doc_json': lexer_renderer(lexers.JsonLexer),
+    'doc_rst': lexer_renderer(lexers.RstLexer),
+    'doc_yaml': lexer_renderer(lexers.YamlLexer),
     'doc_md': wrapped_markdown,
-    'python_callable': lambda x: render(
-        inspect.getsource(x), lexers.PythonLexer),
+    'python_callable': lambda x: _python_renderer(inspect.getsource(x)),
 }
 
 def recurse_tasks(tasks, task_ids, dag_ids, task_id_to_dag):
+    """
+    Walks ``tasks`` (an operator or a list of operators) down through any
+    subdags, adding nested task ids to the ``task_ids`` set, subdag ids to
+    ``dag_ids`` and mapping every task id to its DAG in ``task_id_to_dag``.
+    """
     if isinstance(tasks, list):
         for task in tasks:
             recurse_tasks(task, task_ids, dag_ids, task_id_to_dag)
-        return
-    if isinstance(tasks, SubDagOperator):
+    elif isinstance(tasks, SubDagOperator):
         subtasks = tasks.subdag.tasks
         dag_ids.append(tasks.subdag.dag_id)
         for subtask in subtasks:
             if subtask.task_id not in task_ids:
-                task_ids.append(subtask.task_id)
+                task_ids.add(subtask.task_id)
                 task_id_to_dag[subtask.task_id] = tasks.subdag
         recurse_tasks(subtasks, task_ids, dag_ids, task_id_to_dag)
-    if isinstance(tasks, BaseOperator):
+        task_id_to_dag[tasks.task_id] = tasks.dag
+    elif isinstance(tasks, BaseOperator):
         task_id_to_dag[tasks.task_id] = tasks.dag
 
 
+class TaskOverlay(object):
+    """
+    Stands in for an operator while its templates are rendered. Reads fall
+    through to the wrapped task, but assignments stay on the overlay, so the
+    DAG's task is neither copied nor mutated.
+    """
+    def __init__(self, task):
+        object.__setattr__(self, '_task', task)
+        object.__setattr__(self, '_overrides', {})
+
+    @property
+    def __class__(self):
+        return self._task.__class__
+
+    def __getattr__(self, name):
+        if name in self._overrides:
+            return self._overrides[name]
+        return getattr(self._task, name)
+
+    def __setattr__(self, name, value):
+        self._overrides[name] = value
+
+
+# Seconds per unit returned by airflow.utils.dates.infer_time_unit
+TIME_UNIT_SECONDS = {
+    'minutes': 60,
+    'hours': 60 * 60,
+    'days': 24 * 60 * 60,
+}
+
+
+def infer_time_unit_array(durations):
+    """
+    infer_time_unit for a numpy array of seconds; the unit only depends on
+    the largest value so there's no need to hand over every element
+    """
+    return infer_time_unit([durations.max()] if len(durations) else [])
+
+
+def scale_time_units_array(durations, unit):
+    """
+    scale_time_units for a numpy array of seconds, as a list of floats
+    """
+    return (durations / TIME_UNIT_SECONDS.get(unit, 1)).tolist()
+
+
+CONFIRM_DETAILS_LIMIT = 500
+
+
+def confirm_details(tis):
+    """
+    Lists the task instances an action is about to alter on its confirmation
+    page, up to CONFIRM_DETAILS_LIMIT of them
+    """
+    details = "\n".join(map(str, itertools.islice(tis, CONFIRM_DETAILS_LIMIT)))
+    if len(tis) > CONFIRM_DETAILS_LIMIT:
+        details += "\n... and {} more".format(len(tis) - CONFIRM_DETAILS_LIMIT)
+    return details
+
+
+
+def dag_operators(dag):
+    """
+    Returns the distinct operator classes used by the tasks of a DAG, sorted
+    by class name, for the legend of the tree and graph views
+    """
+    classes = {task.__class__ for task in dag.tasks}
+    return sorted(classes, key=lambda cls: cls.__name__)
+
 def get_chart_height(dag):
     """
     TODO(aoen): See [AIRFLOW-1263] We use the number of tasks in the DAG as a heuristic to
@@ -239,11 +513,17 @@ def get_chart_height(dag):
 
 class AirflowBaseView(BaseView):
 
+    def __init__(self):
+        super(AirflowBaseView, self).__init__()
+        # appbuilder and its base template are fixed once the app is built
+        self.base_context = {
+            'base_template': appbuilder.base_template,
+            'appbuilder': appbuilder,
+        }
+
     def render(self, template, **context):
-        return render_template(template,
-                               base_template=appbuilder.base_template,
-                               appbuilder=appbuilder,
-                               **context)
+        context.update(self.base_context)
+        return render_template(template, **context)
 
 
 class Airflow(AirflowBaseView):
@@ -259,6 +539,9 @@ class Airflow(AirflowBaseView):
         ('percent_area', 'stackedAreaChart'),
         ('datatable', 'datatable'),
     ))
+    chart_classes = {
+        chart_type: getattr(nvd3, class_name, None)
+        for chart_type, class_name in chart_mapping.items()}
 
     def is_visible(self):
         return False
@@ -267,18 +550,15 @@ class Airflow(AirflowBaseView):
     @has_access
     @wwwutils.gzipped
     # @cache.cached(timeout=3600, key_prefix=wwwutils.make_cache_key)
-    def chart_data(self):
+    @provide_session
+    def chart_data(self, session=None):
         from airflow import macros
         import pandas as pd
-        session = settings.Session()
         chart_id = request.args.get('chart_id')
         csv = request.args.get('csv') == "true"
         chart = session.query(models.Chart).filter_by(id=chart_id).first()
         db = session.query(
             models.Connection).filter_by(conn_id=chart.conn_id).first()
-        session.expunge_all()
-        session.commit()
-        session.close()
 
         payload = {
             "state": "ERROR",
@@ -299,13 +579,12 @@ class Airflow(AirflowBaseView):
         request_dict = {k: request.args.get(k) for k in request.args}
         args.update(request_dict)
         args['macros'] = macros
-        sandbox = ImmutableSandboxedEnvironment()
-        sql = sandbox.from_string(chart.sql).render(**args)
-        label = sandbox.from_string(chart.label).render(**args)
+        sql = compile_chart_template(chart.sql).render(**args)
+        label = compile_chart_template(chart.label).render(**args)
         payload['sql_html'] = Markup(highlight(
             sql,
-            lexers.SqlLexer(),  # Lexer call
-            HtmlFormatter(noclasses=True))
+            get_lexer(lexers.SqlLexer),
+            _noclasses_formatter)
         )
         payload['label'] = label
 
@@ -314,15 +593,15 @@ class Airflow(AirflowBaseView):
         try:
             df = hook.get_pandas_df(
                 wwwutils.limit_sql(sql, CHART_LIMIT, conn_type=db.conn_type))
-            df = df.fillna(0)
         except Exception as e:
             payload['error'] += "SQL execution failed. Details: " + str(e)
-
-        if csv:
-            return Response(
-                response=df.to_csv(index=False),
-                status=200,
-                mimetype="application/text")
+        else:
+            if csv:
+                return Response(
+                    response=wwwutils.iter_csv(df),
+                    status=200,
+                    mimetype="application/text")
+            df = df.fillna(0)
 
         if not payload['error'] and len(df) == CHART_LIMIT:
             payload['warning'] = (
@@ -343,7 +622,6 @@ class Airflow(AirflowBaseView):
                     len(df.columns) < 2):
             payload['error'] += "SQL needs to return at least 2 columns. "
         elif not payload['error']:
-            import numpy as np
             chart_type = chart.chart_type
 
             data = None
@@ -359,8 +637,9 @@ class Airflow(AirflowBaseView):
                     # From string to datetime
                     df[df.columns[x_col]] = pd.to_datetime(
                         df[df.columns[x_col]])
-                    df[df.columns[x_col]] = df[df.columns[x_col]].apply(
-                        lambda x: int(x.strftime("%s")) * 1000)
+                    # From datetime64[ns] to epoch milliseconds
+                    df[df.columns[x_col]] = (
+                        df[df.columns[x_col]].astype('int64') // 10 ** 6)
                 except Exception as e:
                     payload['error'] = "Time conversion failed"
 
@@ -370,13 +649,21 @@ class Airflow(AirflowBaseView):
             else:
                 if chart.sql_layout == 'series':
                     # User provides columns (series, x, y)
-                    xaxis_label = df.columns[1]
-                    yaxis_label = df.columns[2]
-                    df[df.columns[2]] = df[df.columns[2]].astype(np.float)
-                    df = df.pivot_table(
-                        index=df.columns[1],
-                        columns=df.columns[0],
-                        values=df.columns[2], aggfunc=np.sum)
+                    series_col, xaxis_label, yaxis_label = df.columns[:3]
+                    df[yaxis_label] = df[yaxis_label].astype(
+                        'float64', copy=False)
+                    # Only aggregate when (series, x) pairs repeat,
+                    # otherwise a plain reshape gives the same frame
+                    if df.duplicated([series_col, xaxis_label]).any():
+                        df = (
+                            df.groupby([xaxis_label, series_col])[yaxis_label]
+                                .sum()
+                                .unstack(series_col))
+                    else:
+                        df = df.pivot(
+                            index=xaxis_label,
+                            columns=series_col,
+                            values=yaxis_label)
                 else:
                     # User provides columns (x, y, metric1, metric2, ...)
                     xaxis_label = df.columns[0]
@@ -385,11 +672,10 @@ class Airflow(AirflowBaseView):
                     df = df.sort(df.columns[0])
                     del df[df.columns[0]]
                     for col in df.columns:
-                        df[col] = df[col].astype(np.float)
+                        df[col] = df[col].astype('float64', copy=False)
 
-                df = df.fillna(0)
-                NVd3ChartClass = self.chart_mapping.get(chart.chart_type)
-                NVd3ChartClass = getattr(nvd3, NVd3ChartClass)
+                df.fillna(0, inplace=True)
+                NVd3ChartClass = self.chart_classes[chart.chart_type]
                 nvd3_chart = NVd3ChartClass(x_is_date=chart.x_is_date)
 
                 for col in df.columns:
@@ -407,14 +693,11 @@ class Airflow(AirflowBaseView):
 
     @expose('/chart')
     @has_access
-    def chart(self):
-        session = settings.Session()
+    @provide_session
+    def chart(self, session=None):
         chart_id = request.args.get('chart_id')
         embed = request.args.get('embed')
         chart = session.query(models.Chart).filter_by(id=chart_id).first()
-        session.expunge_all()
-        session.commit()
-        session.close()
 
         NVd3ChartClass = self.chart_mapping.get(chart.chart_type)
         if not NVd3ChartClass:
@@ -428,8 +711,8 @@ class Airflow(AirflowBaseView):
         if chart.show_sql:
             sql = Markup(highlight(
                 chart.sql,
-                lexers.SqlLexer(),  # Lexer call
-                HtmlFormatter(noclasses=True))
+                get_lexer(lexers.SqlLexer),
+                _noclasses_formatter)
             )
         return self.render(
             'airflow/nvd3.html',
@@ -441,9 +724,10 @@ class Airflow(AirflowBaseView):
 
     @expose('/dag_stats')
     @has_access
-    def dag_stats(self):
+    @wwwutils.gzipped
+    @provide_session
+    def dag_stats(self, session=None):
         ds = models.DagStat
-        session = Session()
 
         ds.update()
 
@@ -458,35 +742,34 @@ class Airflow(AirflowBaseView):
             data[dag_id][state] = count
 
         payload = {}
-        for dag in dagbag.dags.values():
-            payload[dag.safe_dag_id] = []
-            for state in State.dag_states:
-                try:
-                    count = data[dag.dag_id][state]
-                except Exception:
-                    count = 0
-                d = {
-                    'state': state,
-                    'count': count,
-                    'dag_id': dag.dag_id,
-                    'color': State.color(state)
-                }
-                payload[dag.safe_dag_id].append(d)
-        return wwwutils.json_response(payload)
+        for dag in list(get_dagbag().dags.values()):
+            counts = data.get(dag.dag_id, {})
+            payload[dag.safe_dag_id] = [{
+                'state': state,
+                'count': counts.get(state, 0),
+                'dag_id': dag.dag_id,
+                'color': STATE_COLORS[state],
+            } for state in DAG_STATES]
+        return wwwutils.conditional_json_response(payload)
 
     @expose('/task_stats')
     @has_access
-    def task_stats(self):
+    @wwwutils.gzipped
+    @provide_session
+    def task_stats(self, session=None):
         TI = models.TaskInstance
         DagRun = models.DagRun
         Dag = models.DagModel
-        session = Session()
+
+        # Only the DAGs known to this webserver end up in the payload
+        dag_ids = list(get_dagbag().dags.keys())
 
         LastDagRun = (
             session.query(DagRun.dag_id, sqla.func.max(DagRun.execution_date).label('execution_date'))
                 .join(Dag, Dag.dag_id == DagRun.dag_id)
                 .filter(DagRun.state != State.RUNNING)
                 .filter(Dag.is_active == True)
+                .filter(DagRun.dag_id.in_(dag_ids))
                 .group_by(DagRun.dag_id)
                 .subquery('last_dag_run')
         )
@@ -495,6 +778,7 @@ class Airflow(AirflowBaseView):
                 .join(Dag, Dag.dag_id == DagRun.dag_id)
                 .filter(DagRun.state == State.RUNNING)
                 .filter(Dag.is_active == True)
+                .filter(DagRun.dag_id.in_(dag_ids))
                 .subquery('running_dag_run')
         )
 
@@ -519,58 +803,60 @@ class Airflow(AirflowBaseView):
                 .group_by(UnionTI.c.dag_id, UnionTI.c.state)
         )
 
-        data = {}
-        for dag_id, state, count in qry:
-            if dag_id not in data:
-                data[dag_id] = {}
+        data = defaultdict(dict)
+        for dag_id, state, count in session.execute(qry.statement).fetchall():
             data[dag_id][state] = count
-        session.commit()
-        session.close()
 
         payload = {}
-        for dag in dagbag.dags.values():
-            payload[dag.safe_dag_id] = []
-            for state in State.task_states:
-                try:
-                    count = data[dag.dag_id][state]
-                except:
-                    count = 0
-                d = {
-                    'state': state,
-                    'count': count,
-                    'dag_id': dag.dag_id,
-                    'color': State.color(state)
-                }
-                payload[dag.safe_dag_id].append(d)
-        return wwwutils.json_response(payload)
+        for dag in list(get_dagbag().dags.values()):
+            counts = data.get(dag.dag_id, {})
+            payload[dag.safe_dag_id] = [{
+                'state': state,
+                'count': counts.get(state, 0),
+                'dag_id': dag.dag_id,
+                'color': STATE_COLORS[state],
+            } for state in TASK_STATES]
+        return wwwutils.conditional_json_response(payload)
 
     @expose('/code')
     @has_access
     def code(self):
         dag_id = request.args.get('dag_id')
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
         title = dag_id
+
+        # Only a slice of the file is highlighted, e.g. ?lines=2001-4000
+        start, end = 1, CODE_MAX_LINES
+        lines = request.args.get('lines')
+        if lines:
+            try:
+                start, end = [int(n) for n in lines.split('-', 1)]
+            except ValueError:
+                pass
+        start = max(start, 1)
+        end = min(max(end, start), start + CODE_MAX_LINES - 1)
+
+        next_lines = None
         try:
-            with open(dag.fileloc, 'r') as f:
-                code = f.read()
-            html_code = highlight(
-                code, lexers.PythonLexer(), HtmlFormatter(linenos=True))
-        except IOError as e:
+            html_code, has_more = render_dag_source(dag.fileloc, start, end)
+            if has_more:
+                next_lines = '{}-{}'.format(end + 1, end + CODE_MAX_LINES)
+        except (IOError, OSError) as e:
             html_code = str(e)
 
         return self.render(
             'airflow/dag_code.html', html_code=html_code, dag=dag, title=title,
-            root=request.args.get('root'),
-            demo_mode=conf.getboolean('webserver', 'demo_mode'))
+            root=request.args.get('root'), next_lines=next_lines,
+            demo_mode=DEMO_MODE)
 
     @expose('/dag_details')
     @has_access
-    def dag_details(self):
+    @provide_session
+    def dag_details(self, session=None):
         dag_id = request.args.get('dag_id')
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
         title = "DAG details"
 
-        session = settings.Session()
         TI = models.TaskInstance
         states = (
             session.query(TI.state, sqla.func.count(TI.dag_id))
@@ -603,14 +889,15 @@ class Airflow(AirflowBaseView):
 
     @expose('/pickle_info')
     @has_access
+    @wwwutils.gzipped
     def pickle_info(self):
         d = {}
         dag_id = request.args.get('dag_id')
-        dags = [dagbag.dags.get(dag_id)] if dag_id else dagbag.dags.values()
+        dags = [get_dagbag().dags.get(dag_id)] if dag_id else list(get_dagbag().dags.values())
         for dag in dags:
             if not dag.is_subdag:
                 d[dag.dag_id] = dag.pickle_info()
-        return wwwutils.json_response(d)
+        return wwwutils.conditional_json_response(d)
 
     @expose('/rendered')
     @has_access
@@ -621,8 +908,8 @@ class Airflow(AirflowBaseView):
         execution_date = request.args.get('execution_date')
         dttm = dateutil.parser.parse(execution_date)
         form = DateTimeForm(data={'execution_date': dttm})
-        dag = dagbag.get_dag(dag_id)
-        task = copy.copy(dag.get_task(task_id))
+        dag = get_dag(dag_id)
+        task = TaskOverlay(dag.get_task(task_id))
         ti = models.TaskInstance(task=task, execution_date=dttm)
         try:
             ti.render_templates()
@@ -650,14 +937,14 @@ class Airflow(AirflowBaseView):
     @expose('/log')
     @has_access
     @wwwutils.action_logging
-    def log(self):
+    @provide_session
+    def log(self, session=None):
         dag_id = request.args.get('dag_id')
         task_id = request.args.get('task_id')
         execution_date = request.args.get('execution_date')
         dttm = dateutil.parser.parse(execution_date)
         form = DateTimeForm(data={'execution_date': dttm})
-        dag = dagbag.get_dag(dag_id)
-        session = Session()
+        dag = get_dag(dag_id)
         ti = session.query(models.TaskInstance).filter(
             models.TaskInstance.dag_id == dag_id,
             models.TaskInstance.task_id == task_id,
@@ -676,9 +963,9 @@ class Airflow(AirflowBaseView):
                 logs = ["Task log handler {} does not support read logs.\n{}\n" \
                             .format(task_log_reader, str(e))]
 
-        for i, log in enumerate(logs):
-            if PY2 and not isinstance(log, unicode):
-                logs[i] = log.decode('utf-8')
+        if PY2:
+            logs = [log if isinstance(log, unicode) else log.decode('utf-8')
+                    for log in logs]
 
         return self.render(
             'airflow/ti_log.html',
@@ -698,7 +985,7 @@ class Airflow(AirflowBaseView):
         execution_date = request.args.get('execution_date')
         dttm = dateutil.parser.parse(execution_date)
         form = DateTimeForm(data={'execution_date': dttm})
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
 
         if not dag or task_id not in dag.task_ids:
             flash(
@@ -711,20 +998,15 @@ class Airflow(AirflowBaseView):
         ti = TI(task=task, execution_date=dttm)
         ti.refresh_from_db()
 
-        ti_attrs = []
-        for attr_name in dir(ti):
-            if not attr_name.startswith('_'):
-                attr = getattr(ti, attr_name)
-                if type(attr) != type(self.task):
-                    ti_attrs.append((attr_name, str(attr)))
-
-        task_attrs = []
-        for attr_name in dir(task):
-            if not attr_name.startswith('_'):
-                attr = getattr(task, attr_name)
-                if type(attr) != type(self.task) and \
-                        attr_name not in attr_renderer:
-                    task_attrs.append((attr_name, str(attr)))
+        ti_attrs = [
+            (attr_name, str(getattr(ti, attr_name, None)))
+            for attr_name in TI_ATTRS]
+
+        task_attr_names = set(TASK_ATTRS) | set(task.template_fields)
+        task_attrs = [
+            (attr_name, str(getattr(task, attr_name)))
+            for attr_name in sorted(task_attr_names)
+            if attr_name not in attr_renderer and hasattr(task, attr_name)]
 
         # Color coding the special attributes that are code
         special_attrs_rendered = {}
@@ -766,7 +1048,8 @@ class Airflow(AirflowBaseView):
     @expose('/xcom')
     @has_access
     @wwwutils.action_logging
-    def xcom(self):
+    @provide_session
+    def xcom(self, session=None):
         dag_id = request.args.get('dag_id')
         task_id = request.args.get('task_id')
         # Carrying execution_date through, even though it's irrelevant for
@@ -774,7 +1057,7 @@ class Airflow(AirflowBaseView):
         execution_date = request.args.get('execution_date')
         dttm = dateutil.parser.parse(execution_date)
         form = DateTimeForm(data={'execution_date': dttm})
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
         if not dag or task_id not in dag.task_ids:
             flash(
                 "Task [{}.{}] doesn't seem to exist"
@@ -782,15 +1065,14 @@ class Airflow(AirflowBaseView):
                 "error")
             return redirect('/')
 
-        session = Session()
+        # Keys starting with an underscore are internal. Note that
+        # startswith() can't be used here as '_' is a LIKE wildcard.
         xcomlist = session.query(XCom).filter(
             XCom.dag_id == dag_id, XCom.task_id == task_id,
-            XCom.execution_date == dttm).all()
+            XCom.execution_date == dttm,
+            sqla.func.substr(XCom.key, 1, 1) != '_').all()
 
-        attributes = []
-        for xcom in xcomlist:
-            if not xcom.key.startswith('_'):
-                attributes.append((xcom.key, xcom.value))
+        attributes = [(xcom.key, xcom.value) for xcom in xcomlist]
 
         title = "XCom"
         return self.render(
@@ -809,7 +1091,7 @@ class Airflow(AirflowBaseView):
         dag_id = request.args.get('dag_id')
         task_id = request.args.get('task_id')
         origin = request.args.get('origin')
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
         task = dag.get_task(task_id)
 
         execution_date = request.args.get('execution_date')
@@ -839,10 +1121,12 @@ class Airflow(AirflowBaseView):
             ignore_all_deps=ignore_all_deps,
             ignore_task_deps=ignore_task_deps,
             ignore_ti_state=ignore_ti_state)
-        failed_deps = list(ti.get_failed_dep_statuses(dep_context=dep_context))
-        if failed_deps:
+        failed_deps = iter(ti.get_failed_dep_statuses(dep_context=dep_context))
+        first_failed_dep = next(failed_deps, None)
+        if first_failed_dep is not None:
+            failed_deps = itertools.chain([first_failed_dep], failed_deps)
             failed_deps_str = ", ".join(
-                ["{}: {}".format(dep.dep_name, dep.reason) for dep in failed_deps])
+                "{}: {}".format(dep.dep_name, dep.reason) for dep in failed_deps)
             flash("Could not queue task instance for execution, dependencies not met: "
                   "{}".format(failed_deps_str),
                   "error")
@@ -867,7 +1151,7 @@ class Airflow(AirflowBaseView):
     def trigger(self):
         dag_id = request.args.get('dag_id')
         origin = request.args.get('origin') or "/"
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
 
         if not dag:
             flash("Cannot find dag {}".format(dag_id))
@@ -916,7 +1200,7 @@ class Airflow(AirflowBaseView):
             flash("No task instances to clear", 'error')
             response = redirect(origin)
         else:
-            details = "\n".join([str(t) for t in tis])
+            details = confirm_details(tis)
 
             response = self.render(
                 'airflow/confirm.html',
@@ -934,7 +1218,7 @@ class Airflow(AirflowBaseView):
         dag_id = request.args.get('dag_id')
         task_id = request.args.get('task_id')
         origin = request.args.get('origin')
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
 
         execution_date = request.args.get('execution_date')
         execution_date = dateutil.parser.parse(execution_date)
@@ -946,7 +1230,7 @@ class Airflow(AirflowBaseView):
         recursive = request.args.get('recursive') == "true"
 
         dag = dag.sub_dag(
-            task_regex=r"^{0}$".format(task_id),
+            task_regex=re.compile(r"^{0}$".format(re.escape(task_id))),
             include_downstream=downstream,
             include_upstream=upstream)
 
@@ -967,7 +1251,7 @@ class Airflow(AirflowBaseView):
         execution_date = request.args.get('execution_date')
         confirmed = request.args.get('confirmed') == "true"
 
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
         execution_date = dateutil.parser.parse(execution_date)
         start_date = execution_date
         end_date = execution_date
@@ -977,8 +1261,8 @@ class Airflow(AirflowBaseView):
 
     @expose('/blocked')
     @has_access
-    def blocked(self):
-        session = settings.Session()
+    @provide_session
+    def blocked(self, session=None):
         DR = models.DagRun
         dags = (
             session.query(DR.dag_id, sqla.func.count(DR.id))
@@ -986,16 +1270,17 @@ class Airflow(AirflowBaseView):
                 .group_by(DR.dag_id)
                 .all()
         )
-        payload = []
-        for dag_id, active_dag_runs in dags:
-            max_active_runs = 0
-            if dag_id in dagbag.dags:
-                max_active_runs = dagbag.dags[dag_id].max_active_runs
-            payload.append({
-                'dag_id': dag_id,
-                'active_dag_run': active_dag_runs,
-                'max_active_runs': max_active_runs,
-            })
+        dagbag_dags = get_dagbag().dags
+        max_active_runs = {}
+        for dag_id, _ in dags:
+            dag = dagbag_dags.get(dag_id)
+            if dag is not None:
+                max_active_runs[dag_id] = dag.max_active_runs
+        payload = [{
+            'dag_id': dag_id,
+            'active_dag_run': active_dag_runs,
+            'max_active_runs': max_active_runs.get(dag_id, 0),
+        } for dag_id, active_dag_runs in dags]
         return wwwutils.json_response(payload)
 
     @expose('/dagrun_success')
@@ -1013,7 +1298,7 @@ class Airflow(AirflowBaseView):
             return redirect(origin)
 
         execution_date = dateutil.parser.parse(execution_date)
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
 
         if not dag:
             flash('Cannot find DAG: {}'.format(dag_id), 'error')
@@ -1027,7 +1312,7 @@ class Airflow(AirflowBaseView):
             return redirect(origin)
 
         else:
-            details = '\n'.join([str(t) for t in new_dag_state])
+            details = confirm_details(new_dag_state)
 
             response = self.render('airflow/confirm.html',
                                    message=("Here's the list of task instances you are "
@@ -1044,7 +1329,7 @@ class Airflow(AirflowBaseView):
         dag_id = request.args.get('dag_id')
         task_id = request.args.get('task_id')
         origin = request.args.get('origin')
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
         task = dag.get_task(task_id)
         task.dag = dag
 
@@ -1080,7 +1365,7 @@ class Airflow(AirflowBaseView):
                                   future=future, past=past, state=State.SUCCESS,
                                   commit=False)
 
-        details = "\n".join([str(t) for t in to_be_altered])
+        details = confirm_details(to_be_altered)
 
         response = self.render("airflow/confirm.html",
                                message=("Here's the list of task instances you are "
@@ -1093,10 +1378,11 @@ class Airflow(AirflowBaseView):
     @has_access
     @wwwutils.gzipped
     @wwwutils.action_logging
-    def tree(self):
+    @provide_session
+    def tree(self, session=None):
         dag_id = request.args.get('dag_id')
-        blur = conf.getboolean('webserver', 'demo_mode')
-        dag = dagbag.get_dag(dag_id)
+        blur = DEMO_MODE
+        dag = get_dag(dag_id)
         root = request.args.get('root')
         if root:
             dag = dag.sub_dag(
@@ -1104,8 +1390,6 @@ class Airflow(AirflowBaseView):
                 include_downstream=False,
                 include_upstream=True)
 
-        session = settings.Session()
-
         base_date = request.args.get('base_date')
         num_runs = request.args.get('num_runs')
         num_runs = int(num_runs) if num_runs else 25
@@ -1118,9 +1402,14 @@ class Airflow(AirflowBaseView):
         dates = dag.date_range(base_date, num=-abs(num_runs))
         min_date = dates[0] if dates else datetime(2000, 1, 1)
 
+        def isoformat(dttm):
+            return dttm.isoformat() if dttm else dttm
+
+        # Only the dag run fields the tree view reads
         DR = models.DagRun
         dag_runs = (
-            session.query(DR)
+            session.query(DR.dag_id, DR.execution_date, DR.state, DR.run_id,
+                          DR.external_trigger, DR.start_date, DR.end_date)
                 .filter(
                 DR.dag_id == dag.dag_id,
                 DR.execution_date <= base_date,
@@ -1128,59 +1417,75 @@ class Airflow(AirflowBaseView):
                 .all()
         )
         dag_runs = {
-            dr.execution_date: alchemy_to_dict(dr) for dr in dag_runs}
+            execution_date: {
+                'dag_id': dr_dag_id,
+                'execution_date': isoformat(execution_date),
+                'state': state,
+                'run_id': run_id,
+                'external_trigger': external_trigger,
+                'start_date': isoformat(start_date),
+                'end_date': isoformat(end_date),
+            }
+            for (dr_dag_id, execution_date, state, run_id, external_trigger,
+                 start_date, end_date) in dag_runs}
 
         dates = sorted(list(dag_runs.keys()))
         max_date = max(dates) if dates else None
 
+        external_triggers = {
+            execution_date: dr['external_trigger']
+            for execution_date, dr in dag_runs.items()}
+        now = datetime.utcnow()
+
         tis = dag.get_task_instances(
             session, start_date=min_date, end_date=base_date)
         task_instances = {}
         for ti in tis:
             tid = alchemy_to_dict(ti)
-            dr = dag_runs.get(ti.execution_date)
-            tid['external_trigger'] = dr['external_trigger'] if dr else False
+            tid['external_trigger'] = external_triggers.get(
+                ti.execution_date, False)
+            if ti.state == State.RUNNING and ti.start_date is not None:
+                tid['duration'] = (now - ti.start_date).total_seconds()
             task_instances[(ti.task_id, ti.execution_date)] = tid
 
-        expanded = []
+        # Execution dates alongside their isoformat, which placeholder
+        # instances are keyed on
+        iso_dates = [(d, d.isoformat()) for d in dates]
+
+        expanded = set()
         # The default recursion traces every path so that tree view has full
         # expand/collapse functionality. After 5,000 nodes we stop and fall
         # back on a quick DFS search for performance. See PR #320.
         node_count = [0]
         node_limit = 5000 / max(1, len(dag.roots))
 
-        def recurse_nodes(task, visited):
-            visited.add(task)
-            node_count[0] += 1
-
-            children = [
-                recurse_nodes(t, visited) for t in task.upstream_list
-                if node_count[0] < node_limit or t not in visited]
+        # A task reached through several paths shares one instances list
+        instance_lists = {}
 
+        def build_node(task, children):
             # D3 tree uses children vs _children to define what is
             # expanded or not. The following block makes it such that
             # repeated nodes are collapsed by default.
             children_key = 'children'
             if task.task_id not in expanded:
-                expanded.append(task.task_id)
+                expanded.add(task.task_id)
             elif children:
                 children_key = "_children"
 
-            def set_duration(tid):
-                if (isinstance(tid, dict) and tid.get("state") == State.RUNNING and
-                            tid["start_date"] is not None):
-                    d = datetime.utcnow() - dateutil.parser.parse(tid["start_date"])
-                    tid["duration"] = d.total_seconds()
-                return tid
+            task_id = task.task_id
+            instances = instance_lists.get(task_id)
+            if instances is None:
+                instances = [
+                    task_instances.get((task_id, d)) or {
+                        'execution_date': iso_date,
+                        'task_id': task_id
+                    }
+                    for d, iso_date in iso_dates]
+                instance_lists[task_id] = instances
 
             return {
-                'name': task.task_id,
-                'instances': [
-                    set_duration(task_instances.get((task.task_id, d))) or {
-                        'execution_date': d.isoformat(),
-                        'task_id': task.task_id
-                    }
-                    for d in dates],
+                'name': task_id,
+                'instances': instances,
                 children_key: children,
                 'num_dep': len(task.upstream_list),
                 'operator': task.task_type,
@@ -1192,26 +1497,47 @@ class Airflow(AirflowBaseView):
                 'ui_color': task.ui_color,
             }
 
+        def recurse_nodes(root):
+            # Depth-first walk over upstream tasks, kept on an explicit
+            # stack of (task, remaining upstream, built children) frames so
+            # deep DAGs don't hit the interpreter's recursion limit
+            visited = set()
+
+            def enter(task):
+                visited.add(task)
+                node_count[0] += 1
+                return task, iter(task.upstream_list), []
+
+            stack = [enter(root)]
+            while True:
+                task, upstream, children = stack[-1]
+                for t in upstream:
+                    if node_count[0] < node_limit or t not in visited:
+                        stack.append(enter(t))
+                        break
+                else:
+                    stack.pop()
+                    node = build_node(task, children)
+                    if not stack:
+                        return node
+                    stack[-1][2].append(node)
+
         data = {
             'name': '[DAG]',
-            'children': [recurse_nodes(t, set()) for t in dag.roots],
+            'children': [recurse_nodes(t) for t in dag.roots],
             'instances': [
                 dag_runs.get(d) or {'execution_date': d.isoformat()}
                 for d in dates],
         }
 
-        data = json.dumps(data, indent=4, default=json_ser)
-        session.commit()
-        session.close()
+        # Rebinding drops the node dicts before the page is rendered
+        data = wwwutils.compact_dumps(data)
 
         form = DateTimeWithNumRunsForm(data={'base_date': max_date,
                                              'num_runs': num_runs})
         return self.render(
             'airflow/tree.html',
-            operators=sorted(
-                list(set([op.__class__ for op in dag.tasks])),
-                key=lambda x: x.__name__
-            ),
+            operators=dag_operators(dag),
             root=root,
             form=form,
             dag=dag, data=data, blur=blur)
@@ -1220,12 +1546,12 @@ class Airflow(AirflowBaseView):
     @has_access
     @wwwutils.gzipped
     @wwwutils.action_logging
-    def graph(self):
-        session = settings.Session()
+    @provide_session
+    def graph(self, session=None):
         dag_id = request.args.get('dag_id')
-        blur = conf.getboolean('webserver', 'demo_mode')
-        dag = dagbag.get_dag(dag_id)
-        if dag_id not in dagbag.dags:
+        blur = DEMO_MODE
+        dag = get_dag(dag_id)
+        if dag_id not in get_dagbag().dags:
             flash('DAG "{0}" seems to be missing.'.format(dag_id), "error")
             return redirect('/')
 
@@ -1250,15 +1576,18 @@ class Airflow(AirflowBaseView):
                 }
             })
 
+        visited = set()
+
         def get_upstream(task):
+            if task.task_id in visited:
+                return
+            visited.add(task.task_id)
             for t in task.upstream_list:
-                edge = {
+                edges.append({
                     'u': t.task_id,
                     'v': task.task_id,
-                }
-                if edge not in edges:
-                    edges.append(edge)
-                    get_upstream(t)
+                })
+                get_upstream(t)
 
         for t in dag.roots:
             get_upstream(t)
@@ -1275,12 +1604,9 @@ class Airflow(AirflowBaseView):
                 .filter_by(dag_id=dag_id)
                 .order_by(desc(DR.execution_date)).all()
         )
-        dr_choices = []
-        dr_state = None
-        for dr in drs:
-            dr_choices.append((dr.execution_date.isoformat(), dr.run_id))
-            if dttm == dr.execution_date:
-                dr_state = dr.state
+        dr_choices = [(dr.execution_date.isoformat(), dr.run_id) for dr in drs]
+        dr_states = {dr.execution_date: dr.state for dr in drs}
+        dr_state = dr_states.get(dttm)
 
         class GraphForm(Form):
             execution_date = SelectField("DAG run", choices=dr_choices)
@@ -1305,9 +1631,7 @@ class Airflow(AirflowBaseView):
             for t in dag.tasks}
         if not tasks:
             flash("No tasks found", "error")
-        session.commit()
-        session.close()
-        doc_md = markdown.markdown(dag.doc_md) if hasattr(dag, 'doc_md') and dag.doc_md else ''
+        doc_md = render_markdown(dag.doc_md) if getattr(dag, 'doc_md', None) else ''
 
         return self.render(
             'airflow/graph.html',
@@ -1319,24 +1643,21 @@ class Airflow(AirflowBaseView):
             state_token=state_token(dr_state),
             doc_md=doc_md,
             arrange=arrange,
-            operators=sorted(
-                list(set([op.__class__ for op in dag.tasks])),
-                key=lambda x: x.__name__
-            ),
+            operators=dag_operators(dag),
             blur=blur,
             root=root or '',
-            task_instances=json.dumps(task_instances, indent=2),
-            tasks=json.dumps(tasks, indent=2),
-            nodes=json.dumps(nodes, indent=2),
-            edges=json.dumps(edges, indent=2), )
+            task_instances=wwwutils.compact_dumps(task_instances),
+            tasks=wwwutils.compact_dumps(tasks),
+            nodes=wwwutils.compact_dumps(nodes),
+            edges=wwwutils.compact_dumps(edges), )
 
     @expose('/duration')
     @has_access
     @wwwutils.action_logging
-    def duration(self):
-        session = settings.Session()
+    @provide_session
+    def duration(self, session=None):
         dag_id = request.args.get('dag_id')
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
         base_date = request.args.get('base_date')
         num_runs = request.args.get('num_runs')
         num_runs = int(num_runs) if num_runs else 25
@@ -1371,33 +1692,40 @@ class Airflow(AirflowBaseView):
         TF = models.TaskFail
         ti_fails = (
             session
-                .query(TF)
+                .query(TF.dag_id, TF.task_id, TF.execution_date,
+                       sqla.func.sum(TF.duration))
                 .filter(
                 TF.dag_id == dag.dag_id,
                 TF.execution_date >= min_date,
                 TF.execution_date <= base_date,
                 TF.task_id.in_([t.task_id for t in dag.tasks]))
+                .group_by(TF.dag_id, TF.task_id, TF.execution_date)
                 .all()
         )
 
-        fails_totals = defaultdict(int)
-        for tf in ti_fails:
-            dict_key = (tf.dag_id, tf.task_id, tf.execution_date)
-            fails_totals[dict_key] += tf.duration
+        fails_totals = {
+            (tf_dag_id, tf_task_id, tf_execution_date): duration or 0
+            for tf_dag_id, tf_task_id, tf_execution_date, duration in ti_fails}
 
         for ti in tis:
             if ti.duration:
                 dttm = wwwutils.epoch(ti.execution_date)
                 x[ti.task_id].append(dttm)
                 y[ti.task_id].append(float(ti.duration))
-                fails_dict_key = (ti.dag_id, ti.task_id, ti.execution_date)
-                fails_total = fails_totals[fails_dict_key]
+                fails_total = fails_totals.get(
+                    (ti.dag_id, ti.task_id, ti.execution_date), 0)
                 cum_y[ti.task_id].append(float(ti.duration + fails_total))
 
+        import numpy as np
+        y = {k: np.array(v, dtype=np.float64) for k, v in y.items()}
+        cum_y = {k: np.array(v, dtype=np.float64) for k, v in cum_y.items()}
+
         # determine the most relevant time unit for the set of task instance
         # durations for the DAG
-        y_unit = infer_time_unit([d for t in y.values() for d in t])
-        cum_y_unit = infer_time_unit([d for t in cum_y.values() for d in t])
+        y_unit = infer_time_unit_array(
+            np.concatenate(list(y.values())) if y else np.empty(0))
+        cum_y_unit = infer_time_unit_array(
+            np.concatenate(list(cum_y.values())) if cum_y else np.empty(0))
         # update the y Axis on both charts to have the correct time units
         chart.create_y_axis('yAxis', format='.02f', custom_format=False,
                             label='Duration ({})'.format(y_unit))
@@ -1406,17 +1734,15 @@ class Airflow(AirflowBaseView):
         for task in dag.tasks:
             if x[task.task_id]:
                 chart.add_serie(name=task.task_id, x=x[task.task_id],
-                                y=scale_time_units(y[task.task_id], y_unit))
+                                y=scale_time_units_array(y[task.task_id],
+                                                         y_unit))
                 cum_chart.add_serie(name=task.task_id, x=x[task.task_id],
-                                    y=scale_time_units(cum_y[task.task_id],
-                                                       cum_y_unit))
+                                    y=scale_time_units_array(cum_y[task.task_id],
+                                                             cum_y_unit))
 
         dates = sorted(list({ti.execution_date for ti in tis}))
         max_date = max([ti.execution_date for ti in tis]) if dates else None
 
-        session.commit()
-        session.close()
-
         form = DateTimeWithNumRunsForm(data={'base_date': max_date,
                                              'num_runs': num_runs})
         chart.buildcontent()
@@ -1429,7 +1755,7 @@ class Airflow(AirflowBaseView):
         return self.render(
             'airflow/duration_chart.html',
             dag=dag,
-            demo_mode=conf.getboolean('webserver', 'demo_mode'),
+            demo_mode=DEMO_MODE,
             root=root,
             form=form,
             chart=chart.htmlcontent,
@@ -1439,10 +1765,10 @@ class Airflow(AirflowBaseView):
     @expose('/tries')
     @has_access
     @wwwutils.action_logging
-    def tries(self):
-        session = settings.Session()
+    @provide_session
+    def tries(self, session=None):
         dag_id = request.args.get('dag_id')
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
         base_date = request.args.get('base_date')
         num_runs = request.args.get('num_runs')
         num_runs = int(num_runs) if num_runs else 25
@@ -1467,25 +1793,22 @@ class Airflow(AirflowBaseView):
             name="lineChart", x_is_date=True, y_axis_format='d', height=chart_height,
             width="1200")
 
+        tis = dag.get_task_instances(
+            session, start_date=min_date, end_date=base_date)
+        task_tis = defaultdict(list)
+        for ti in tis:
+            task_tis[ti.task_id].append(ti)
+
         for task in dag.tasks:
-            y = []
-            x = []
-            for ti in task.get_task_instances(session, start_date=min_date,
-                                              end_date=base_date):
-                dttm = wwwutils.epoch(ti.execution_date)
-                x.append(dttm)
-                y.append(ti.try_number)
+            x = [wwwutils.epoch(ti.execution_date)
+                 for ti in task_tis[task.task_id]]
+            y = [ti.try_number for ti in task_tis[task.task_id]]
             if x:
                 chart.add_serie(name=task.task_id, x=x, y=y)
 
-        tis = dag.get_task_instances(
-            session, start_date=min_date, end_date=base_date)
         tries = sorted(list({ti.try_number for ti in tis}))
         max_date = max([ti.execution_date for ti in tis]) if tries else None
 
-        session.commit()
-        session.close()
-
         form = DateTimeWithNumRunsForm(data={'base_date': max_date,
                                              'num_runs': num_runs})
 
@@ -1494,7 +1817,7 @@ class Airflow(AirflowBaseView):
         return self.render(
             'airflow/chart.html',
             dag=dag,
-            demo_mode=conf.getboolean('webserver', 'demo_mode'),
+            demo_mode=DEMO_MODE,
             root=root,
             form=form,
             chart=chart.htmlcontent
@@ -1503,10 +1826,10 @@ class Airflow(AirflowBaseView):
     @expose('/landing_times')
     @has_access
     @wwwutils.action_logging
-    def landing_times(self):
-        session = settings.Session()
+    @provide_session
+    def landing_times(self, session=None):
         dag_id = request.args.get('dag_id')
-        dag = dagbag.get_dag(dag_id)
+        dag = get_dag(dag_id)
         base_date = request.args.get('base_date')
         num_runs = request.args.get('num_runs')
         num_runs = int(num_runs) if num_runs else 25
@@ -1529,21 +1852,28 @@ class Airflow(AirflowBaseView):
         chart_height = get_chart_height(dag)
         chart = nvd3.lineChart(
             name="lineChart", x_is_date=True, height=chart_height, width="1200")
-        y = {}
-        x = {}
-        for task in dag.tasks:
-            y[task.task_id] = []
-            x[task.task_id] = []
-            for ti in task.get_task_instances(session, start_date=min_date,
-                                              end_date=base_date):
-                ts = ti.execution_date
-                if dag.schedule_interval and dag.following_schedule(ts):
-                    ts = dag.following_schedule(ts)
-                if ti.end_date:
-                    dttm = wwwutils.epoch(ti.execution_date)
-                    secs = (ti.end_date - ts).total_seconds()
-                    x[ti.task_id].append(dttm)
-                    y[ti.task_id].append(secs)
+        # Task instances of one run share an execution date, so only
+        # compute each run's following schedule once
+        following_schedules = {}
+
+        def following_schedule(dttm):
+            if dttm not in following_schedules:
+                following_schedules[dttm] = dag.following_schedule(dttm)
+            return following_schedules[dttm]
+
+        y = defaultdict(list)
+        x = defaultdict(list)
+        tis = dag.get_task_instances(
+            session, start_date=min_date, end_date=base_date)
+        for ti in tis:
+            ts = ti.execution_date
+            if dag.schedule_interval:
+                ts = following_schedule(ts) or ts
+            if ti.end_date:
+                dttm = wwwutils.epoch(ti.execution_date)
+                secs = (ti.end_date - ts).total_seconds()
+                x[ti.task_id].append(dttm)
+                y[ti.task_id].append(secs)
 
         # determine the most relevant time unit for the set of landing times
         # for the DAG
@@ -1556,14 +1886,9 @@ class Airflow(AirflowBaseView):
                 chart.add_serie(name=task.task_id, x=x[task.task_id],
                                 y=scale_time_units(y[task.task_id], y_unit))
 
-        tis = dag.get_task_instances(
-            session, start_date=min_date, end_date=base_date)
         dates = sorted(list({ti.execution_date for ti in tis}))
         max_date = max([ti.execution_date for ti in tis]) if dates else None
 
-        session.commit()
-        session.close()
-
         form = DateTimeWithNumRunsForm(data={'base_date': max_date,
                                              'num_runs': num_runs})
         chart.buildcontent()
@@ -1572,7 +1897,7 @@ class Airflow(AirflowBaseView):
             dag=dag,
             chart=chart.htmlcontent,
             height=str(chart_height + 100) + "px",
-            demo_mode=conf.getboolean('webserver', 'demo_mode'),
+            demo_mode=DEMO_MODE,
             root=root,
             form=form,
         )
@@ -1580,10 +1905,10 @@ class Airflow(AirflowBaseView):
     @expose('/paused', methods=['POST'])
     @has_access
     @wwwutils.action_logging
-    def paused(self):
+    @provide_session
+    def paused(self, session=None):
         DagModel = models.DagModel
         dag_id = request.args.get('dag_id')
-        session = settings.Session()
         orm_dag = session.query(
             DagModel).filter(DagModel.dag_id == dag_id).first()
         if request.args.get('is_paused') == 'false':
@@ -1592,18 +1917,16 @@ class Airflow(AirflowBaseView):
             orm_dag.is_paused = False
         session.merge(orm_dag)
         session.commit()
-        session.close()
 
-        dagbag.get_dag(dag_id)
         return "OK"
 
     @expose('/refresh')
     @has_access
     @wwwutils.action_logging
-    def refresh(self):
+    @provide_session
+    def refresh(self, session=None):
         DagModel = models.DagModel
         dag_id = request.args.get('dag_id')
-        session = settings.Session()
         orm_dag = session.query(
             DagModel).filter(DagModel.dag_id == dag_id).first()
 
@@ -1611,9 +1934,9 @@ class Airflow(AirflowBaseView):
             orm_dag.last_expired = datetime.utcnow()
             session.merge(orm_dag)
         session.commit()
-        session.close()
 
-        dagbag.get_dag(dag_id)
+        # get_dag reloads the DAG file now that it is marked as expired
+        get_dag(dag_id)
         flash("DAG [{}] is now fresh as a daisy".format(dag_id))
         return redirect(request.referrer)
 
@@ -1621,18 +1944,17 @@ class Airflow(AirflowBaseView):
     @has_access
     @wwwutils.action_logging
     def refresh_all(self):
-        dagbag.collect_dags(only_if_updated=False)
+        collect_dags(only_if_updated=False)
         flash("All DAGs are now up to date")
         return redirect('/')
 
     @expose('/gantt')
     @has_access
     @wwwutils.action_logging
-    def gantt(self):
-        session = settings.Session()
+    @provide_session
+    def gantt(self, session=None):
         dag_id = request.args.get('dag_id')
-        dag = dagbag.get_dag(dag_id)
-        demo_mode = conf.getboolean('webserver', 'demo_mode')
+        dag = get_dag(dag_id)
 
         root = request.args.get('root')
         if root:
@@ -1649,10 +1971,18 @@ class Airflow(AirflowBaseView):
 
         form = DateTimeForm(data={'execution_date': dttm})
 
-        tis = [
-            ti for ti in dag.get_task_instances(session, dttm, dttm)
-            if ti.start_date]
-        tis = sorted(tis, key=lambda ti: ti.start_date)
+        TI = models.TaskInstance
+        tis = (
+            session.query(TI.task_id, TI.execution_date, TI.start_date,
+                          TI.end_date, TI.state)
+                .filter(
+                TI.dag_id == dag.dag_id,
+                TI.execution_date == dttm,
+                TI.task_id.in_(dag.task_ids),
+                TI.start_date.isnot(None))
+                .order_by(TI.start_date)
+                .all()
+        )
 
         tasks = []
         for ti in tis:
@@ -1675,27 +2005,28 @@ class Airflow(AirflowBaseView):
             'height': len(tis) * 25 + 25,
         }
 
-        session.commit()
-        session.close()
-
         return self.render(
             'airflow/gantt.html',
             dag=dag,
             execution_date=dttm.isoformat(),
             form=form,
-            data=json.dumps(data, indent=2),
+            data=wwwutils.compact_dumps(data),
             base_date='',
-            demo_mode=demo_mode,
+            demo_mode=DEMO_MODE,
             root=root,
         )
 
     @expose('/object/task_instances')
     @has_access
     @wwwutils.action_logging
-    def task_instances(self):
-        session = settings.Session()
+    @provide_session
+    def task_instances(self, session=None):
         dag_id = request.args.get('dag_id')
-        dag = dagbag.get_dag(dag_id)
+        # polled by the graph view, so never parse the DAGs folder here; the
+        # background refresh loads it
+        if _dagbag is None or dag_id not in _dagbag.dags:
+            return ("Error: DAG {} is not loaded yet".format(escape(dag_id))), 404
+        dag = get_dag(dag_id)
 
         dttm = request.args.get('execution_date')
         if dttm:
@@ -1703,21 +2034,32 @@ class Airflow(AirflowBaseView):
         else:
             return ("Error: Invalid execution_date")
 
-        task_instances = {
-            ti.task_id: alchemy_to_dict(ti)
-            for ti in dag.get_task_instances(session, dttm, dttm)}
+        # only the columns the graph view's refresh reads
+        TI = models.TaskInstance
+        rows = (
+            session.query(TI.task_id, TI.execution_date, TI.start_date,
+                          TI.end_date, TI.duration, TI.state)
+            .filter(TI.dag_id == dag.dag_id,
+                    TI.execution_date == dttm,
+                    TI.task_id.in_(dag.task_ids))
+            .all()
+        )
+        task_instances = {row.task_id: row._asdict() for row in rows}
 
-        return json.dumps(task_instances)
+        return Response(
+            response=wwwutils.compact_dumps(task_instances),
+            status=200,
+            mimetype="application/json")
 
     @expose('/variables/<form>', methods=["GET", "POST"])
     @has_access
     @wwwutils.action_logging
-    def variables(self, form):
+    @provide_session
+    def variables(self, form, session=None):
         try:
             if request.method == 'POST':
                 data = request.json
                 if data:
-                    session = settings.Session()
                     var = models.Variable(key=form, val=json.dumps(data))
                     session.add(var)
                     session.commit()
@@ -1735,15 +2077,25 @@ class Airflow(AirflowBaseView):
     @expose('/varimport', methods=["GET", "POST"])
     @has_access
     @wwwutils.action_logging
-    def varimport(self):
+    @provide_session
+    def varimport(self, session=None):
         try:
             out = str(request.files['file'].read())
             d = json.loads(out)
         except Exception:
             flash("Missing file or syntax error.")
         else:
-            for k, v in d.items():
-                models.Variable.set(k, v, serialize_json=isinstance(v, dict))
+            # same as Variable.set for each key, in a single transaction; the
+            # rows are built through the model so values still get encrypted
+            Variable = models.Variable
+            if d:
+                session.query(Variable).filter(
+                    Variable.key.in_(list(d.keys()))
+                ).delete(synchronize_session=False)
+                session.add_all([
+                    Variable(key=k, val=json.dumps(v) if isinstance(v, dict) else v)
+                    for k, v in d.items()])
+                session.commit()
             flash("{} variable(s) successfully updated.".format(len(d)))
         return redirect('/variable/list')
 
@@ -1753,8 +2105,8 @@ class HomeView(AirflowBaseView):
 
     @expose('home')
     @has_access
-    def index(self):
-        session = Session()
+    @provide_session
+    def index(self, session=None):
         DM = models.DagModel
 
         hide_paused_dags_by_default = conf.getboolean('webserver',
@@ -1780,7 +2132,6 @@ class HomeView(AirflowBaseView):
         else:
             hide_paused = hide_paused_dags_by_default
 
-        # read orm_dags from the db
         sql_query = session.query(DM).filter(
             ~DM.is_subdag, DM.is_active
         )
@@ -1788,54 +2139,53 @@ class HomeView(AirflowBaseView):
         # optionally filter out "paused" dags
         if hide_paused:
             sql_query = sql_query.filter(~DM.is_paused)
+        base_query = sql_query
 
-        orm_dags = {dag.dag_id: dag for dag
-                    in sql_query
-                    .all()}
-
-        import_errors = session.query(models.ImportError).all()
-        for ie in import_errors:
-            flash(
-                "Broken DAG: [{ie.filename}] {ie.stacktrace}".format(ie=ie),
-                "error")
-        session.expunge_all()
-        session.commit()
-        session.close()
-
-        # get a list of all non-subdag dags visible to everyone
-        # optionally filter out "paused" dags
+        # DAG.is_paused queries the db on every access, so look the paused
+        # flags up once for the whole dagbag
+        paused_dag_ids = set()
         if hide_paused:
-            unfiltered_webserver_dags = [dag for dag in dagbag.dags.values() if
-                                         not dag.parent_dag and not dag.is_paused]
+            paused_dag_ids = {
+                dag_id for dag_id, in session.query(DM.dag_id).filter(DM.is_paused)}
 
-        else:
-            unfiltered_webserver_dags = [dag for dag in dagbag.dags.values() if
-                                         not dag.parent_dag]
+        # snapshot of the non-subdag dags visible to everyone, optionally
+        # without "paused" dags, lowercased once for searching
+        dag_entries = [
+            (dag.dag_id, dag.dag_id.lower(), dag.owner, dag.owner.lower(), dag)
+            for dag in list(get_dagbag().dags.values())
+            if not dag.parent_dag and dag.dag_id not in paused_dag_ids
+        ]
 
-        webserver_dags = {
-            dag.dag_id: dag
-            for dag in unfiltered_webserver_dags
-        }
+        auto_complete_data = set()
+        for dag_id, owners in sql_query.with_entities(DM.dag_id, DM.owners).distinct():
+            auto_complete_data.add(dag_id)
+            auto_complete_data.add(owners)
 
+        lower_search_query = ''
         if arg_search_query:
             lower_search_query = arg_search_query.lower()
-            # filter by dag_id
-            webserver_dags_filtered = {
-                dag_id: dag
-                for dag_id, dag in webserver_dags.items()
-                if (lower_search_query in dag_id.lower() or
-                    lower_search_query in dag.owner.lower())
-            }
-
-            all_dag_ids = (set([dag.dag_id for dag in orm_dags.values()
-                                if lower_search_query in dag.dag_id.lower() or
-                                lower_search_query in dag.owners.lower()]) |
-                           set(webserver_dags_filtered.keys()))
-
-            sorted_dag_ids = sorted(all_dag_ids)
-        else:
-            webserver_dags_filtered = webserver_dags
-            sorted_dag_ids = sorted(set(orm_dags.keys()) | set(webserver_dags.keys()))
+            # match the search query literally, as the dagbag filter does
+            pattern = '%{}%'.format(
+                re.sub(r'([\\%_])', r'\\\1', arg_search_query))
+            sql_query = sql_query.filter(sqla.or_(
+                DM.dag_id.ilike(pattern, escape='\\'),
+                DM.owners.ilike(pattern, escape='\\')))
+
+        # filter by dag_id or owner in the same pass that collects the dags
+        # for the page and the autocomplete; '' is in every string
+        webserver_dags_filtered = {}
+        for dag_id, lower_dag_id, owner, lower_owner, dag in dag_entries:
+            if (lower_search_query in lower_dag_id or
+                    lower_search_query in lower_owner):
+                webserver_dags_filtered[dag_id] = dag
+                auto_complete_data.add(dag_id)
+                auto_complete_data.add(owner)
+
+        # only the matching dag_ids come back from the db; paging still has
+        # to cover dags that are known to the dagbag alone
+        orm_dag_ids = {
+            dag_id for dag_id, in sql_query.with_entities(DM.dag_id)}
+        sorted_dag_ids = sorted(orm_dag_ids | set(webserver_dags_filtered.keys()))
 
         start = current_page * dags_per_page
         end = start + dags_per_page
@@ -1844,13 +2194,21 @@ class HomeView(AirflowBaseView):
         page_dag_ids = sorted_dag_ids[start:end]
         num_of_pages = int(math.ceil(num_of_all_dags / float(dags_per_page)))
 
-        auto_complete_data = set()
-        for dag in webserver_dags_filtered.values():
-            auto_complete_data.add(dag.dag_id)
-            auto_complete_data.add(dag.owner)
-        for dag in orm_dags.values():
-            auto_complete_data.add(dag.dag_id)
-            auto_complete_data.add(dag.owners)
+        # only the rows shown on this page are read in full, as column-only
+        # rows rather than entities; dags.html marks the page's dags without
+        # an active, non-subdag row as existing only locally
+        orm_dags = {}
+        if page_dag_ids:
+            orm_dags = {
+                dag.dag_id: dag for dag in
+                base_query.with_entities(DM.dag_id, DM.owners, DM.is_paused)
+                          .filter(DM.dag_id.in_(page_dag_ids))}
+
+        import_errors = session.query(models.ImportError).all()
+        for ie in import_errors:
+            flash(
+                "Broken DAG: [{ie.filename}] {ie.stacktrace}".format(ie=ie),
+                "error")
 
         return self.render(
             'airflow/dags.html',
@@ -1911,15 +2269,51 @@ class CustomSQLAInterfaceWrapper(SQLAInterface):
     they are not supported by WTForm.
 
     """
+    # model class -> (list_properties, list_columns) with the names cleaned
+    _cleaned_columns = {}
+
     def __init__(self, obj, session=None):
         super(CustomSQLAInterfaceWrapper, self).__init__(obj, session)
         def clean_column_names():
-            if self.list_properties:
-                self.list_properties = dict((k.lstrip('_'), v) for k, v in self.list_properties.items())
-            if self.list_columns:
-                self.list_columns = dict((k.lstrip('_'), v) for k, v in self.list_columns.items())        
+            cleaned = self._cleaned_columns.get(obj)
+            if cleaned is None:
+                cleaned = tuple(
+                    dict((k.lstrip('_'), v) for k, v in columns.items()) if columns else columns
+                    for columns in (self.list_properties, self.list_columns))
+                self._cleaned_columns[obj] = cleaned
+            self.list_properties, self.list_columns = cleaned
         clean_column_names()
 
+    def query(self, filters=None, order_column='', order_direction='',
+              page=None, page_size=None):
+        """
+        Same as SQLAInterface.query, except that the separate count query is
+        only run when the total can not be told from the page itself, e.g.
+        a short last page already gives it away
+        """
+        if order_column and '.' in order_column:
+            # ordering on a related model's column needs FAB's join
+            return super(CustomSQLAInterfaceWrapper, self).query(
+                filters=filters, order_column=order_column,
+                order_direction=order_direction, page=page, page_size=page_size)
+        query = self._get_base_query(query=self.session.query(self.obj),
+                                     filters=filters,
+                                     order_column=order_column,
+                                     order_direction=order_direction)
+        offset = page * page_size if page else 0
+        if page:
+            query = query.offset(offset)
+        if page_size:
+            query = query.limit(page_size)
+        items = query.all()
+
+        if not page_size or (len(items) < page_size and (items or not page)):
+            return offset + len(items), items
+
+        query_count = self.session.query(sqla.func.count('*')).select_from(self.obj)
+        query_count = self._get_base_query(query=query_count, filters=filters)
+        return query_count.scalar(), items
+
 
 # todo: add support for form_widget
 class SlaMissModelView(AirflowModelViewReadOnly):
@@ -2022,7 +2416,8 @@ class PoolModelView(AirflowModelView):
         pool_id = attr.get('pool')
         if pool_id is not None:
             url = '/taskinstance/list/?_flt_3_pool=' + str(pool_id)
-            return Markup("<a href='{url}'>{pool_id}</a>".format(**locals()))
+            return Markup("<a href='{url}'>{pool_id}</a>").format(
+                url=url, pool_id=pool_id)
         else:
             return Markup('<span class="label label-danger">Invalid</span>')
 
@@ -2031,7 +2426,8 @@ class PoolModelView(AirflowModelView):
         used_slots = attr.get('used_slots')
         if pool_id is not None and used_slots is not None:
             url = '/taskinstance/list/?_flt_3_pool=' + str(pool_id) + '&_flt_3_state=running'
-            return Markup("<a href='{url}'>{used_slots}</a>".format(**locals()))
+            return Markup("<a href='{url}'>{used_slots}</a>").format(
+                url=url, used_slots=used_slots)
         else:
             return Markup('<span class="label label-danger">Invalid</span>')
 
@@ -2040,7 +2436,8 @@ class PoolModelView(AirflowModelView):
         queued_slots = attr.get('queued_slots')
         if pool_id is not None and queued_slots is not None:
             url = '/taskinstance/list/?_flt_3_pool=' + str(pool_id) + '&_flt_3_state=queued'
-            return Markup("<a href='{url}'>{queued_slots}</a>".format(**locals()))
+            return Markup("<a href='{url}'>{queued_slots}</a>").format(
+                url=url, queued_slots=queued_slots)
         else:
             return Markup('<span class="label label-danger">Invalid</span>')
 
@@ -2056,6 +2453,10 @@ class PoolModelView(AirflowModelView):
     }
 
 
+# Shown in place of the values of sensitive variables
+_HIDDEN = Markup('*' * 8)
+
+
 class VariableModelView(AirflowModelView):
     route_base='/variable'
 
@@ -2074,7 +2475,7 @@ class VariableModelView(AirflowModelView):
         key = attr.get('key')
         val = attr.get('val')
         if wwwutils.should_hide_value_for_key(key):
-            return Markup('*' * 8)
+            return _HIDDEN
         if val:
             return val
         else:
@@ -2110,7 +2511,10 @@ class VariableModelView(AirflowModelView):
                 val = var.val
             var_dict[var.key] = val
 
-        response = make_response(json.dumps(var_dict, sort_keys=True, indent=4))
+        response = Response(
+            response=wwwutils.iter_json_object(var_dict),
+            status=200,
+            mimetype="application/json")
         response.headers["Content-Disposition"] = "attachment; filename=variables.json"
         return response
 
@@ -2162,16 +2566,15 @@ class DagRunModelView(AirflowModelView):
         'dag_id': [ validators.DataRequired() ]
     }
 
+    @provide_session
     @action('muldelete', "Delete", "Are you sure you want to delete selected records?", single=False)
-    def action_muldelete(self, items):
+    def action_muldelete(self, items, session=None):
+        # read the dag_ids before the rows are deleted and expired
+        dirty_ids = list({item.dag_id for item in items})
         self.datamodel.delete_all(items)
+        models.DagStat.update(dirty_ids, dirty_only=False, session=session)
         self.update_redirect()
         return redirect(self.get_redirect())
-        dirty_ids = []
-        for item in items:
-            dirty_ids.append(item.dag_id)
-        models.DagStat.update(dirty_ids, dirty_only=False, session=session)
-        session.close()
 
     @action('set_running', "Set state to 'running'", '', single=False)
     def action_set_running(self, drs):
@@ -2189,19 +2592,19 @@ class DagRunModelView(AirflowModelView):
     def set_dagrun_state(self, drs, target_state, session=None):
         try:
             DR = models.DagRun
-            count = 0
-            dirty_ids = []
-            for dr in session.query(DR).filter(
-                    DR.id.in_([dagrun.id for dagrun in drs])).all():
-                dirty_ids.append(dr.dag_id)
-                count += 1
-                dr.state = target_state
-                if target_state == State.RUNNING:
-                    dr.start_date = datetime.now()
-                else:
-                    dr.end_date = datetime.now()
+            values = {DR.state: target_state}
+            if target_state == State.RUNNING:
+                values[DR.start_date] = datetime.now()
+            else:
+                values[DR.end_date] = datetime.now()
+            count = session.query(DR).filter(
+                DR.id.in_([dagrun.id for dagrun in drs])
+            ).update(values, synchronize_session=False)
+            dirty_ids = list({dagrun.dag_id for dagrun in drs})
             session.commit()
-            models.DagStat.update(dirty_ids, session=session)
+            # the bulk UPDATE bypasses the DagRun.state setter that marks the
+            # DagStat rows dirty, so recount them unconditionally
+            models.DagStat.update(dirty_ids, dirty_only=False, session=session)
             flash(
                 "{count} dag runs were set to '{target_state}'".format(**locals()))
         except Exception as ex:
@@ -2251,7 +2654,7 @@ class TaskInstanceModelView(AirflowModelView):
         return Markup(
             '<a href="{log_url}">'
             '    <span class="glyphicon glyphicon-book" aria-hidden="true">'
-            '</span></a>').format(**locals())
+            '</span></a>').format(log_url=log_url)
 
     def duration_f(attr):
         end_date = attr.get('end_date')
@@ -2277,15 +2680,14 @@ class TaskInstanceModelView(AirflowModelView):
                 ' selected task instance(s) and set their dagruns to the running state?'), single=False)
     def action_clear(self, tis, session=None):
         try:
-            dag_to_tis = {}
-
+            dag_id_to_tis = defaultdict(list)
             for ti in tis:
-                dag = dagbag.get_dag(ti.dag_id)
-                tis = dag_to_tis.setdefault(dag, [])
-                tis.append(ti)
+                dag_id_to_tis[ti.dag_id].append(ti)
 
-            for dag, tis in dag_to_tis.items():
-                models.clear_task_instances(tis, session, dag=dag)
+            # look each DAG up once rather than once per task instance
+            for dag_id, dag_tis in dag_id_to_tis.items():
+                dag = get_dag(dag_id)
+                models.clear_task_instances(dag_tis, session, dag=dag)
 
             session.commit()
             flash("{0} task instances have been cleared".format(len(tis)))
@@ -2298,9 +2700,21 @@ class TaskInstanceModelView(AirflowModelView):
     @provide_session
     def set_task_instance_state(self, tis, target_state, session=None):
         try:
+            TI = models.TaskInstance
             count = len(tis)
-            for ti in tis:
-                ti.set_state(target_state, session)
+            # one UPDATE for the whole selection, setting the same columns
+            # as TaskInstance.set_state
+            now = datetime.utcnow()
+            if tis:
+                session.query(TI).filter(sqla.or_(*[
+                    sqla.and_(TI.dag_id == ti.dag_id,
+                              TI.task_id == ti.task_id,
+                              TI.execution_date == ti.execution_date)
+                    for ti in tis])
+                ).update({TI.state: target_state,
+                          TI.start_date: now,
+                          TI.end_date: now},
+                         synchronize_session=False)
             session.commit()
             flash(
                 "{count} task instances were set to '{target_state}'".format(**locals()))
@@ -2380,11 +2794,7 @@ class ConfigurationView(AirflowBaseView):
         raw = request.args.get('raw') == "true"
         title = "Airflow Configuration"
         subtitle = conf.AIRFLOW_CONFIG
-        with open(conf.AIRFLOW_CONFIG, 'r') as f:
-            config = f.read()
-        table = [(section, key, value, source)
-                 for section, parameters in conf.as_dict(True, True).items()
-                 for key, (value, source) in parameters.items()]
+        config, table, code_html = get_config_page()
 
         if raw:
             return Response(
@@ -2392,11 +2802,6 @@ class ConfigurationView(AirflowBaseView):
                 status=200,
                 mimetype="application/text")
         else:
-            code_html = Markup(highlight(
-                config,
-                lexers.IniLexer(),  # Lexer call
-                HtmlFormatter(noclasses=True))
-            )
             return self.render(
                 'airflow/config.html',
                 pre_subtitle=settings.HEADER + "  v" + airflow.__version__,